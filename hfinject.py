@@ -24,9 +24,229 @@ import re
 import sys
 import gzip
 import json
+import math
+import time
 import string
+import hashlib
 import configparser
 
+class FileChecker:
+    """
+    Keeps track of file freshness for a `GameInjector`, trying to touch the
+    disk as little as possible.  This is mostly for folks running off of
+    slow filesystems (WSL's `/mnt/c`, NFS, SMB shares, etc), where every
+    single `os.stat()` can be a noticeable round-trip.
+
+    Each file check results in a "signature" tuple of `(mtime, size, digest)`,
+    or `None` if the file doesn't exist.  `digest` will only be populated if
+    `hash_check` is enabled, which catches edits which don't change the
+    mtime (at the cost of reading the whole file whenever we look at it).
+
+    Within a single request, any given file is only ever checked once.  If
+    `revalidate_seconds` is nonzero, signatures are also trusted across
+    requests for that many seconds without going to disk at all.
+
+    `stat_mode` can be `stat` (one `os.stat()` per file) or `scandir` (one
+    `os.scandir()` per directory).  `scandir` only actually saves anything on
+    native Windows, where the directory listing already contains the stat
+    info -- everywhere else it'd be a stat per file *plus* the listing, so
+    `read_freshness_config()` won't select it on other platforms.
+    """
+
+    stat_modes = {'stat', 'scandir'}
+
+    def __init__(self, stat_mode='stat', revalidate_seconds=0, hash_check=False):
+        self.stat_mode = stat_mode
+        self.revalidate_seconds = revalidate_seconds
+        self.hash_check = hash_check
+
+        # Signatures which we've seen, and when we checked them
+        self.signatures = {}
+        self.checked_at = {}
+
+        # Per-request data
+        self.dir_entries = {}
+        self.seen_this_request = set()
+        self.counts = {}
+        self.begin_request()
+
+    def begin_request(self):
+        """
+        Resets our per-request caches and call counters.
+        """
+        self.dir_entries = {}
+        self.seen_this_request = set()
+        self.counts = {
+                'stat': 0,
+                'scandir': 0,
+                'read': 0,
+                'open': 0,
+                'cached': 0,
+                }
+
+    def report(self):
+        """
+        Returns a string describing the filesystem calls made during this request.
+        """
+        return '{} stat, {} scandir, {} hash read, {} open ({} served from cache)'.format(
+                self.counts['stat'],
+                self.counts['scandir'],
+                self.counts['read'],
+                self.counts['open'],
+                self.counts['cached'],
+                )
+
+    def _stat_scandir(self, pathname):
+        """
+        Returns a stat result for `pathname` (or `None` if it doesn't exist),
+        using a single `os.scandir()` per directory per request.
+        """
+        dirname, basename = os.path.split(pathname)
+        if dirname not in self.dir_entries:
+            entries = {}
+            self.counts['scandir'] += 1
+            try:
+                with os.scandir(dirname if dirname else '.') as it:
+                    for entry in it:
+                        entries[entry.name] = entry
+            except OSError:
+                pass
+            self.dir_entries[dirname] = entries
+        entry = self.dir_entries[dirname].get(basename)
+        if entry is None:
+            # Names in the listing are matched exactly, but the filesystem may
+            # well be case-insensitive (and the path may be shaped oddly, such
+            # as with a trailing separator), so fall back to a real stat
+            # before declaring the file missing.
+            return self._stat_direct(pathname)
+        try:
+            return entry.stat()
+        except OSError:
+            return None
+
+    def _stat_direct(self, pathname):
+        """
+        Returns a stat result for `pathname` via a single `os.stat()`, or
+        `None` if it doesn't exist.
+        """
+        self.counts['stat'] += 1
+        try:
+            return os.stat(pathname)
+        except OSError:
+            return None
+
+    def _stat(self, pathname):
+        """
+        Returns a stat result for `pathname`, or `None` if it doesn't exist.
+        """
+        if self.stat_mode == 'scandir':
+            return self._stat_scandir(pathname)
+        return self._stat_direct(pathname)
+
+    def _digest(self, pathname):
+        """
+        Returns a hash of the raw contents of `pathname`, or `None` if the
+        file couldn't be read.
+        """
+        self.counts['read'] += 1
+        hasher = hashlib.sha1()
+        try:
+            with open(pathname, 'rb') as df:
+                for chunk in iter(lambda: df.read(65536), b''):
+                    hasher.update(chunk)
+        except OSError:
+            return None
+        return hasher.hexdigest()
+
+    def signature(self, pathname):
+        """
+        Returns the current signature for `pathname`, or `None` if the file
+        doesn't exist.  Will use cached data if we've already checked the file
+        during this request, or within our revalidation window.
+        """
+        if pathname in self.signatures:
+            if pathname in self.seen_this_request:
+                self.counts['cached'] += 1
+                return self.signatures[pathname]
+            if self.revalidate_seconds > 0 and \
+                    time.monotonic() - self.checked_at[pathname] < self.revalidate_seconds:
+                self.seen_this_request.add(pathname)
+                self.counts['cached'] += 1
+                return self.signatures[pathname]
+
+        stat_result = self._stat(pathname)
+        sig = None
+        if stat_result is not None:
+            if self.hash_check:
+                # If we can stat the file but not read it, treat it as unusable
+                digest = self._digest(pathname)
+                if digest is not None:
+                    sig = (stat_result.st_mtime_ns, stat_result.st_size, digest)
+            else:
+                sig = (stat_result.st_mtime_ns, stat_result.st_size, None)
+
+        self.signatures[pathname] = sig
+        self.checked_at[pathname] = time.monotonic()
+        self.seen_this_request.add(pathname)
+        return sig
+
+    def exists(self, pathname):
+        """
+        Returns `True` if `pathname` exists.  Primes our signature cache, so
+        a later freshness check on the same file is free.
+        """
+        return self.signature(pathname) is not None
+
+    def forget_except(self, pathnames):
+        """
+        Drops cached signatures for any file not in `pathnames`, so files which
+        are no longer referenced don't hang around forever.
+        """
+        for pathname in list(self.signatures.keys()):
+            if pathname not in pathnames:
+                del self.signatures[pathname]
+                del self.checked_at[pathname]
+
+def read_freshness_config(config):
+    """
+    Reads our optional file-freshness settings from the `main` section of
+    the given `config`, returning a dict of keyword arguments suitable for
+    `FileChecker`.  Invalid values will be reported and replaced with the
+    defaults.  These settings are shared between games, so this should only
+    be called once.
+    """
+    options = {
+            'stat_mode': 'stat',
+            'revalidate_seconds': 0,
+            'hash_check': False,
+            }
+    if 'main' not in config:
+        return options
+    main = config['main']
+
+    stat_mode = main.get('stat_mode', fallback=options['stat_mode']).strip().lower()
+    if stat_mode not in FileChecker.stat_modes:
+        print(f'WARNING: Unknown stat_mode "{stat_mode}" in hfinject.ini, using "stat"')
+    elif stat_mode == 'scandir' and os.name != 'nt':
+        print('NOTICE: stat_mode "scandir" only helps on native Windows, using "stat"')
+    else:
+        options['stat_mode'] = stat_mode
+
+    try:
+        revalidate_seconds = main.getfloat('revalidate_seconds', fallback=options['revalidate_seconds'])
+        if not math.isfinite(revalidate_seconds) or revalidate_seconds < 0:
+            raise ValueError()
+        options['revalidate_seconds'] = revalidate_seconds
+    except ValueError:
+        print('WARNING: Invalid revalidate_seconds in hfinject.ini, using 0')
+
+    try:
+        options['hash_check'] = main.getboolean('hash_check', fallback=options['hash_check'])
+    except ValueError:
+        print('WARNING: Invalid hash_check in hfinject.ini, using false')
+
+    return options
+
 class GameInjector:
     """
     Generic class to describe how to inject hotfixes for a generic game.
@@ -74,7 +294,7 @@ class GameInjector:
     # entire mod set.
     type_11_re = re.compile(r'^SparkEarlyLevelPatchEntry,\(1,11,[01],(?P<map_name>[A-Za-z0-9_]+)\),.*')
 
-    def __init__(self, config):
+    def __init__(self, config, freshness):
 
         # Vars given to the initializers
         self.upper = self.shortname.upper()
@@ -82,7 +302,8 @@ class GameInjector:
         moddir_param = f'moddir_{self.shortname}'
 
         # Various bits of data
-        self.mtimes = {}
+        # Signature of each modlist/mod file as of when we last parsed it
+        self.processed_sigs = {}
         self.file_includes = set()
         self.mod_data = {}
         self.to_load = []
@@ -91,6 +312,9 @@ class GameInjector:
         self.modlist_pathname = None
         self.initialized = False
 
+        # File-freshness checking; `freshness` comes from `read_freshness_config()`
+        self.checker = FileChecker(**freshness)
+
         if 'main' in config and moddir_param in config['main']:
             self.mod_dir = config['main'][moddir_param]
             self.modlist_pathname = os.path.join(self.mod_dir, 'modlist.txt')
@@ -128,12 +352,17 @@ class GameInjector:
         """
         Reads a list of modfiles to load from the given `filename`.  Will
         recurse through `!include` statements, if found.  Will also update
-        our mtime cache for this file
+        our record of this file's signature
         """
 
-        self.mtimes[filename] = os.path.getmtime(filename)
+        cur_sig = self.checker.signature(filename)
+        self.processed_sigs[filename] = cur_sig
+        if cur_sig is None:
+            self.output(f'WARNING: {filename} not found')
+            return []
 
         to_load = []
+        self.checker.counts['open'] += 1
         with open(filename) as df:
             for line in df:
                 line = line.strip()
@@ -146,7 +375,7 @@ class GameInjector:
                     split_include = line.split(maxsplit=1)
                     if len(split_include) == 2:
                         included_filename = self._get_mod_path(split_include[1])
-                        if os.path.exists(included_filename):
+                        if self.checker.exists(included_filename):
                             self.output(f'{filename} includes file {included_filename}')
                             to_load.extend(self._get_modfiles(included_filename))
                             self.file_includes.add(included_filename)
@@ -157,7 +386,7 @@ class GameInjector:
                 else:
                     # We got a modfile line, so add it to our list
                     mod_path = self._get_mod_path(line)
-                    if os.path.exists(mod_path):
+                    if self.checker.exists(mod_path):
                         to_load.append(mod_path)
                     else:
                         self.output(f'WARNING: {mod_path} not found')
@@ -171,18 +400,22 @@ class GameInjector:
 
         # Get a list of files to check.  Ordinarily this'll just be the single main
         # modfile, but if we've processed any `!include` statements, we might have
-        # more than one.  If *any* file mtime isn't present in our `self.mtimes`, or
-        # if its mtime doesn't match, we'll re-load the whole lot.
+        # more than one.  If *any* file signature isn't present in our `self.processed_sigs`,
+        # or if its signature (mtime, size, and optional hash) doesn't match, we'll
+        # re-load the whole lot.
         files_to_check = [self.modlist_pathname]
         files_to_check.extend(list(self.file_includes))
 
-        # Now do that mtime check.
+        # Now do that signature check.
         do_load = False
         for file_to_check in files_to_check:
-            cur_mtime = os.path.getmtime(file_to_check)
-            if file_to_check in self.mtimes:
-                if self.mtimes[file_to_check] != cur_mtime:
-                    self.output(f'{file_to_check} has been updated, loading modlist...')
+            cur_sig = self.checker.signature(file_to_check)
+            if file_to_check in self.processed_sigs:
+                if self.processed_sigs[file_to_check] != cur_sig:
+                    if cur_sig is None:
+                        self.output(f'{file_to_check} has been removed, loading modlist...')
+                    else:
+                        self.output(f'{file_to_check} has been updated, loading modlist...')
                     do_load = True
                     break
             else:
@@ -200,23 +433,33 @@ class GameInjector:
         self.to_load = self._get_modfiles(self.modlist_pathname)
         self.output('Set {} mod(s) to load'.format(len(self.to_load)))
 
+        # Forget about anything which is no longer referenced
+        referenced = {self.modlist_pathname} | self.file_includes | set(self.to_load)
+        for pathname in list(self.processed_sigs.keys()):
+            if pathname not in referenced:
+                del self.processed_sigs[pathname]
+        for pathname in list(self.mod_data.keys()):
+            if pathname not in referenced:
+                del self.mod_data[pathname]
+        self.checker.forget_except(referenced)
+
     def process_mod(self, pathname):
 
         # Make sure the mod file exists, and fail gracefully rather than allowing
-        # an exception
-        if not os.path.exists(pathname):
-            if pathname in self.mtimes:
-                del self.mtimes[pathname]
+        # an exception.  This single check also gets us the file's signature.
+        cur_sig = self.checker.signature(pathname)
+        if cur_sig is None:
+            if pathname in self.processed_sigs:
+                del self.processed_sigs[pathname]
             self.output(f'WARNING: {pathname} not found')
             return ([], [], set())
 
         # Now continue on
         hf_counter = 0
-        cur_mtime = os.path.getmtime(pathname)
-        if pathname in self.mtimes and self.mtimes[pathname] == cur_mtime:
+        if pathname in self.processed_sigs and self.processed_sigs[pathname] == cur_sig:
             return self.mod_data[pathname]
         self.output(f'Processing {pathname}')
-        self.mtimes[pathname] = cur_mtime
+        self.processed_sigs[pathname] = cur_sig
         statements = []
         type_11s = []
         type_11_maps = set()
@@ -228,6 +471,7 @@ class GameInjector:
         self.next_prefix += 1
 
         # Read the file
+        self.checker.counts['open'] += 1
         if pathname.endswith('.gz'):
             df = gzip.open(pathname, mode='rt')
         else:
@@ -322,6 +566,7 @@ class GameInjector:
             cur_data['services'].append(micropatch_service)
 
         # Load our mod list
+        self.checker.begin_request()
         self.load_modlist()
         regulars = []
         type_11_maps = set()
@@ -334,6 +579,7 @@ class GameInjector:
             micropatch_service['parameters'].extend(new_type_11s)
             type_11_count += len(new_type_11s)
             type_11_maps |= new_type_11_maps
+        self.output(f'Filesystem calls for this request: {self.checker.report()}')
 
         # If we have any type-11 hotfixes, introduce some artificial delay statements.
         # We're keeping track of used lowercase names just in case we see mixed case
@@ -429,9 +675,10 @@ class InjectHotfix:
         # Now read in the ini file
         config = configparser.ConfigParser()
         config.read('hfinject.ini')
+        freshness = read_freshness_config(config)
         self.handlers = [
-                BL3(config),
-                WL(config),
+                BL3(config, freshness),
+                WL(config, freshness),
                 ]
 
     def response(self, flow):
@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+# vim: set expandtab tabstop=4 shiftwidth=4:
+
+# Copyright 2019-2022 Christopher J. Kucera
+# <cj@apocalyptech.com>
+# <http://apocalyptech.com/contact.php>
+#
+# Borderlands 3 / Wonderlands Hotfix Injector is free software: you can redistribute it
+# and/or modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation, either version 3 of
+# the License, or (at your option) any later version.
+#
+# Borderlands 3 / Wonderlands Hotfix Injector is distributed in the hope that it will
+# be useful, but WITHOUT ANY WARRANTY; without even the implied
+# warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Borderlands 3 / Wonderlands Hotfix Injector.  If not, see
+# <https://www.gnu.org/licenses/>.
+
+# Standalone sanity checks for the file-freshness handling in hfinject.py,
+# since none of that gets exercised unless mitmproxy is actually running and
+# the game requests hotfixes.  Doesn't require mitmproxy; just run:
+#
+#     python3 hfinject_check.py
+#
+# Everything happens inside a temporary directory, which is removed afterwards.
+
+import os
+import sys
+import json
+import time
+import types
+import tempfile
+import configparser
+
+script_dir = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, script_dir)
+
+def write(pathname, data):
+    with open(pathname, 'w') as df:
+        df.write(data)
+
+def make_flow():
+    """
+    Returns a fake mitmproxy flow containing a minimal verification response
+    """
+    data = {'services': [{'service_name': 'Micropatch', 'parameters': []}]}
+    response = types.SimpleNamespace(
+            headers={},
+            data=types.SimpleNamespace(content=json.dumps(data).encode('utf8')),
+            )
+    return types.SimpleNamespace(response=response)
+
+def injected_count(flow):
+    data = json.loads(flow.response.data.content.decode('utf8'))
+    return len(data['services'][0]['parameters'])
+
+def make_config(**options):
+    config = configparser.ConfigParser()
+    config['main'] = {'moddir_bl3': 'mods'}
+    config['main'].update({k: str(v) for k, v in options.items()})
+    return config
+
+def check_call_counts(hfinject):
+    print('Checking per-request call counts...')
+    checker = hfinject.FileChecker()
+    assert checker.exists('mods/a.txt')
+    assert checker.signature('mods/a.txt') is not None
+    assert not checker.exists('mods/missing.txt')
+    assert checker.counts['stat'] == 2, checker.report()
+    assert checker.counts['cached'] == 1, checker.report()
+    checker.begin_request()
+    checker.signature('mods/a.txt')
+    assert checker.counts['stat'] == 1, checker.report()
+
+def check_revalidation(hfinject):
+    print('Checking revalidation window...')
+    checker = hfinject.FileChecker(revalidate_seconds=0.5)
+    orig_sig = checker.signature('mods/a.txt')
+    write('mods/a.txt', 'SparkPatchEntry,(1,2,0,),/Game/X,Y,Z,0,,100\n')
+    checker.begin_request()
+    assert checker.signature('mods/a.txt') == orig_sig
+    assert checker.counts['stat'] == 0, checker.report()
+    time.sleep(0.6)
+    checker.begin_request()
+    assert checker.signature('mods/a.txt') != orig_sig
+    assert checker.counts['stat'] == 1, checker.report()
+
+def check_hash(hfinject):
+    print('Checking content hashing...')
+    plain = hfinject.FileChecker()
+    hashed = hfinject.FileChecker(hash_check=True)
+    plain_sig = plain.signature('mods/b.txt')
+    hashed_sig = hashed.signature('mods/b.txt')
+    assert hashed.counts['read'] == 1, hashed.report()
+
+    # Same-size edit, with the original mtime restored
+    stat_result = os.stat('mods/b.txt')
+    with open('mods/b.txt') as df:
+        data = df.read()
+    write('mods/b.txt', data.replace('Y', 'Q'))
+    os.utime('mods/b.txt', ns=(stat_result.st_atime_ns, stat_result.st_mtime_ns))
+
+    plain.begin_request()
+    hashed.begin_request()
+    assert plain.signature('mods/b.txt') == plain_sig
+    assert hashed.signature('mods/b.txt') != hashed_sig
+
+    # Something we can stat but not read should be treated as missing
+    assert not hashed.exists('mods')
+
+def check_scandir(hfinject):
+    print('Checking scandir mode...')
+    checker = hfinject.FileChecker(stat_mode='scandir')
+    for pathname in ['mods/a.txt', 'mods/b.txt', 'mods/missing.txt', 'mods/A.TXT', 'mods/', 'mods']:
+        assert checker.exists(pathname) == os.path.exists(pathname), pathname
+    assert checker.counts['scandir'] == 2, checker.report()
+
+def check_config(hfinject):
+    print('Checking config parsing...')
+    defaults = hfinject.read_freshness_config(make_config())
+    assert defaults == {'stat_mode': 'stat', 'revalidate_seconds': 0, 'hash_check': False}
+    for bad in ['-1', 'nan', 'inf', 'bogus']:
+        options = hfinject.read_freshness_config(make_config(revalidate_seconds=bad))
+        assert options['revalidate_seconds'] == 0, bad
+    options = hfinject.read_freshness_config(make_config(revalidate_seconds='2.5', hash_check='yes'))
+    assert options['revalidate_seconds'] == 2.5
+    assert options['hash_check'] is True
+    options = hfinject.read_freshness_config(make_config(stat_mode='scandir'))
+    assert options['stat_mode'] == ('scandir' if os.name == 'nt' else 'stat')
+
+def check_injection(hfinject):
+    print('Checking hotfix injection...')
+    config = make_config()
+    injector = hfinject.BL3(config, hfinject.read_freshness_config(config))
+
+    flow = make_flow()
+    injector.handle_response(flow)
+    assert injected_count(flow) == 2
+    assert injector.checker.counts['cached'] > 0, injector.checker.report()
+    # modlist.txt, sub.txt, a.txt, and b.txt
+    assert injector.checker.counts['open'] == 4, injector.checker.report()
+
+    # Dropping mods from the modlist should only re-read modlist.txt, since
+    # a.txt is unchanged
+    write('mods/modlist.txt', 'a.txt\n')
+    flow = make_flow()
+    injector.handle_response(flow)
+    assert injected_count(flow) == 1
+    assert injector.checker.counts['open'] == 1, injector.checker.report()
+
+    # Files which dropped out of the modlist should be forgotten
+    for pathname in ['mods/sub.txt', 'mods/b.txt', 'mods/missing.txt']:
+        assert pathname not in injector.processed_sigs, pathname
+        assert pathname not in injector.mod_data, pathname
+        assert pathname not in injector.checker.signatures, pathname
+        assert pathname not in injector.checker.checked_at, pathname
+
+    # Removing the modlist while running should be handled gracefully
+    os.unlink('mods/modlist.txt')
+    flow = make_flow()
+    injector.handle_response(flow)
+    assert injected_count(flow) == 0
+    assert 'mods/a.txt' not in injector.mod_data
+
+    write('mods/modlist.txt', 'a.txt\n')
+    flow = make_flow()
+    injector.handle_response(flow)
+    assert injected_count(flow) == 1
+
+def main():
+    with tempfile.TemporaryDirectory() as tempdir:
+        # Importing hfinject will create an hfinject.ini in the current dir
+        # if one doesn't exist, so do everything from inside our temp dir.
+        os.chdir(tempdir)
+        os.mkdir('mods')
+        write('mods/modlist.txt', 'a.txt\nmissing.txt\n!include sub.txt\n')
+        write('mods/sub.txt', 'b.txt\n')
+        write('mods/a.txt', 'SparkPatchEntry,(1,2,0,),/Game/X,Y,Z,0,,1\n')
+        write('mods/b.txt', 'SparkPatchEntry,(1,2,0,),/Game/X,Y,Z,0,,2\n')
+        import hfinject
+
+        check_call_counts(hfinject)
+        check_injection(hfinject)
+        check_revalidation(hfinject)
+        check_hash(hfinject)
+        check_scandir(hfinject)
+        check_config(hfinject)
+        os.chdir(script_dir)
+
+    print('All checks passed')
+
+if __name__ == '__main__':
+    main()